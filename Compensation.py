@@ -2,6 +2,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 import tkinter as tki
 import time
+from queue import Queue
+from threading import Thread
 
 import TimeTagger as TimeTagger
 
@@ -9,6 +11,22 @@ from ELL14 import ElliptecController
 
 
 
+def _cd_step(q_l, q, q_r, h):
+    """
+    Newton step of the 2nd order coordinate descent from the QBERs measured
+    at position - h, position and position + h. Returns the signed change
+    of the waveplate angle in degrees.
+    """
+    # Vertex -B/(2A) of the parabola A*x^2 + B*x + C through the three points,
+    # with a = 2*h^2*A and b = h*B. Dividing by |a| steps towards the minimum
+    # if the parabola is convex and away from the maximum if it is concave:
+    a = q_l - 2 * q + q_r
+    b = (q_r - q_l) / 2.0
+    step = -h * b / abs(a)
+    # Make sure to never change by more than 5 degrees:
+    return min(max(step, -5.0), 5.0)
+
+
 class ContinuousPolarizationOptimizer:
     """
     Class that continuously randomly varies waveplate positions and
@@ -35,11 +53,29 @@ class ContinuousPolarizationOptimizer:
         self._current_pos = 1
         self._origin_position = 0
         self._qbers = np.array([0.1, 0.1, 0.1])
+        # Direction of the probing move issued after measuring at each position,
+        # in units of max_stepsize_deg (which may be changed between calls):
+        self._deltas = np.array([0.0, +1.0, -1.0])
         # Relevant for random minimizer:
+        # Fixed-size ring buffer, empty slots hold inf so they never win argmin:
         self._n_stored = n_stored
-        self._previous_qbers = np.array([0.5])
-        self._previous_positions = np.array([self._positions])
+        self._previous_qbers = np.full(n_stored, np.inf)
+        self._previous_positions = np.zeros((n_stored, len(waveplates)), dtype=float)
+        self._head = 0
+        # Random perturbations are drawn in batches and consumed one per call:
+        self._rng = np.random.default_rng()
+        self._rand_batch_n = 1024
+        self._refill_rand()
     
+    def _refill_rand(self):
+        """
+        Draw a new batch of random steps (in units of max_stepsize_deg,
+        which may be changed between calls) and waveplate indices.
+        """
+        self._dphi = self._rng.uniform(-1.0, 1.0, self._rand_batch_n)
+        self._wpidx = self._rng.integers(0, len(self._waveplates), self._rand_batch_n)
+        self._ri = 0
+
     def get_positions(self):
         positions = np.array([0, 0], dtype=float)
         for i in (0, 1):
@@ -92,29 +128,34 @@ class ContinuousPolarizationOptimizer:
         try:
             positions = self.get_positions()
             # Change "default" state if new QBER is better than any old one:
-            if qber < np.min(self._previous_qbers):
+            best_idx = int(self._previous_qbers.argmin())
+            best_qber = self._previous_qbers[best_idx]
+            if qber < best_qber:
                 self._positions = positions
             else:
-                self._positions = self._previous_positions[np.argmin(self._previous_qbers)]
+                self._positions[:] = self._previous_positions[best_idx]
+                # Send both moves before reading the responses so the waveplates move simultaneously:
                 for i in (0, 1):
-                    self._waveplates[i].move_absolute_deg(self._positions[i])
-            # Append new QBER and setting to lists:
-            if len(self._previous_qbers) < self._n_stored:
-                self._previous_qbers = np.append(self._previous_qbers, qber)
-                self._previous_positions = np.append(self._previous_positions, [positions], axis=0)
-            else:
-                self._previous_qbers = np.append(self._previous_qbers[1:], qber)
-                self._previous_positions = np.append(self._previous_positions[1:], [positions], axis=0)
+                    self._waveplates[i].start_move_absolute_deg(self._positions[i])
+                ElliptecController.await_moves(*self._waveplates)
+            # Store new QBER and setting in the ring buffer (overwrites the oldest):
+            self._previous_qbers[self._head] = qber
+            self._previous_positions[self._head] = positions
+            self._head = (self._head + 1) % self._n_stored
         except Exception as e:
             print(e)
             print("Error during Polarization Optimization")
 
         # Apply voltage change with random sign and amplitude to a random channel:
-        delta_phi = np.random.uniform(-self._max_stepsize_deg, self._max_stepsize_deg)
-        wp = np.random.randint(0, 2)
+        if self._ri >= self._rand_batch_n:
+            self._refill_rand()
+        delta_phi = self._dphi[self._ri] * self._max_stepsize_deg
+        wp = int(self._wpidx[self._ri])
+        self._ri += 1
 
         self._waveplates[wp].move_relative_deg(delta_phi)
-        self._positions = self.get_positions()
+        # Only this waveplate moved, its position was updated from the move response:
+        self._positions[wp] = self._waveplates[wp].position
 
     def coordinate_descent_2nd_order(self, qber):
         """
@@ -132,40 +173,32 @@ class ContinuousPolarizationOptimizer:
             self._current_pos = 1
         # Otherwise, perform second order coordinate descent:
         else:
+            # Local names for the attributes used below:
+            current_wp = self._current_wp
+            current_pos = self._current_pos
+            wp = self._waveplates[current_wp]
+            qbers = self._qbers
+            h = self._max_stepsize_deg
             # If current QBER value is the "central" one,
             # set current voltage as origin voltage:
-            if self._current_pos == 1:
-                position = self._waveplates[self._current_wp].get_position_deg()
+            if current_pos == 1:
+                position = wp.get_position_deg()
                 self._origin_position = position
             else:
                 position = self._origin_position
             # print("POS: ",position)
-            # print("Current pos: ", self._current_pos)
-            self._qbers[self._current_pos] = qber
-            if self._current_pos == 1:
-                self._waveplates[self._current_wp].move_absolute_deg(position + self._max_stepsize_deg)
-            if self._current_pos == 2:
-                self._waveplates[self._current_wp].move_absolute_deg(position - self._max_stepsize_deg)
-            if self._current_pos == 0:
-                # Compute and set new voltage via discrete first derivative:
-                q_l, q, q_r = self._qbers
-                dQ_dV = (q_r - q_l) / (2 * self._max_stepsize_deg)
-                dQ2_dV2 = (q_r - 2 * q + q_l)
-                dQ2_dV2 /= (self._max_stepsize_deg ** 2)
-                step = dQ_dV / dQ2_dV2
-                # print(f"Step: {step} dqdv: {dQ_dV}, dqdv2: {dQ2_dV2}")
-                # Make sure to never change by more than 5V:
-                sign = -1 if step < 0 else +1
-                if np.abs(step) > 60:
-                    step = sign * 5
-                
-                # Move the correct way depending on sign of second derivative:
-                if dQ2_dV2 > 0:
-                    self._waveplates[self._current_wp].move_absolute_deg(position - step)
-                else:
-                    self._waveplates[self._current_wp].move_absolute_deg(position + step)
-            # Update position and channel:
-            self._positions = self.get_positions()
+            # print("Current pos: ", current_pos)
+            qbers[current_pos] = qber
+            if current_pos != 0:
+                # Probe the right (+) or left (-) neighbour of the origin position:
+                wp.move_absolute_deg(position + self._deltas[current_pos] * h)
+            else:
+                # Compute and set new position via discrete derivatives:
+                q_l, q, q_r = qbers
+                step = _cd_step(q_l, q, q_r, h)
+                wp.move_absolute_deg(position + step)
+            # Update position (known from the move response) and channel:
+            self._positions[current_wp] = wp.position
             # print(f"Position, Channel, Orientations: {self._current_pos}, {self._current_wp}, {self._positions}")
             self._current_pos += 1
             self._current_pos %= 3
@@ -177,9 +210,11 @@ if __name__ == "__main__":
     # Test run setup
     TESTING = False
     total_meas_duration = 10  # seconds
-    indiv_meas_duration = 0.1
+    indiv_meas_duration = 0.1  # used while QBER is above threshold
+    short_meas_duration = 0.02  # used while QBER is below threshold
     n_iterations = 300
     stepsize_deg = 2 
+    threshold = 0.001
 
     tt_channels = [3, 4] # Channel 3 (H), Channel 4 (V)
     qbers = np.zeros(n_iterations)
@@ -191,7 +226,7 @@ if __name__ == "__main__":
     wp_2 = ElliptecController(address="2", verbose=True)
     waveplates = (wp_1, wp_2)
     # optimizer = ContinuousPolarizationOptimizer(waveplates=waveplates, )
-    optimizer = ContinuousPolarizationOptimizer(waveplates, max_stepsize_deg=stepsize_deg, threshold=0.001)
+    optimizer = ContinuousPolarizationOptimizer(waveplates, max_stepsize_deg=stepsize_deg, threshold=threshold)
 
     # ===== Homing =====
     wp_1.home(direction=0) # Homing device 0
@@ -207,19 +242,50 @@ if __name__ == "__main__":
         ctr = TimeTagger.Countrate(tagger, tt_channels)
         time.sleep(1)
 
+    def measure_qber(meas_duration):
+        """Acquire counts for a window of meas_duration seconds and return the QBER."""
+        if TESTING:
+            return np.random.uniform(0, 0.2)
+        ctr.startFor(int(meas_duration * 1e12), clear=True)  # duration in ps
+        ctr.waitUntilFinished()
+        data = ctr.getData()
+        cts_h = data[0] # Channel 3 (H)
+        cts_v = data[1] # Channel 4 (V)
+        return cts_h / (cts_h + cts_v)
+
+    # Measurement thread: runs a measurement for every duration put in q_meas and
+    # returns the QBER via q_qber, so acquisition overlaps the waveplate moves.
+    # The optimizer then acts on the QBER of the previous step (Jacobi-like).
+    # Note that each window starts before the optimizer issues its move, so the
+    # QBER also contains counts taken while the waveplate was still moving, even
+    # though it is stored in _qbers as if it was measured at the probe position.
+    q_meas = Queue()
+    q_qber = Queue()
+
+    def measurement_worker():
+        while (meas_duration := q_meas.get()) is not None:
+            try:
+                q_qber.put(measure_qber(meas_duration))
+            except Exception as e:
+                q_qber.put(e)  # re-raised in the main loop
+                return
+
+    worker = Thread(target=measurement_worker, daemon=True)
+    worker.start()
+    q_meas.put(short_meas_duration)  # first measurement
+
     # MEASUREMENT LOOP
     for i in range(n_iterations):
         print(f"Iteration {i}")
-        if TESTING:
-            qber = np.random.uniform(0, 0.2)
-        else:
-            ctr = TimeTagger.Countrate(tagger, tt_channels) # CRITICAL
-            time.sleep(indiv_meas_duration)
-            cts_h = ctr.getData()[0] # Channel 3 (H)
-            cts_v = ctr.getData()[1] # Channel 4 (V)
-            qber = cts_h / (cts_h + cts_v)
-            # print(f"Pos. Device 0: {wp_1.get_position_deg()}° \t Pos. Dev. 2: {wp_2.get_position_deg()}°")
-            print("QBER: ", qber)
+        qber = q_qber.get()
+        if isinstance(qber, Exception):
+            raise qber
+        # Start the next measurement while the optimizer moves the waveplates.
+        # Poll with a short window while the QBER is good, use the full one otherwise:
+        meas_duration = indiv_meas_duration if qber >= threshold else short_meas_duration
+        q_meas.put(meas_duration if i < n_iterations - 1 else None)
+        # print(f"Pos. Device 0: {wp_1.get_position_deg()}° \t Pos. Dev. 2: {wp_2.get_position_deg()}°")
+        print("QBER: ", qber)
 
         # === update the max_stepsize_deg according to the qber ===
         optimizer._max_stepsize_deg = stepsize_deg * qber
@@ -231,6 +297,8 @@ if __name__ == "__main__":
         pos_wp1[i] = wp_1.get_position_deg()
         pos_wp2[i] = wp_2.get_position_deg()
 
+    worker.join()
+
     # Close COM port
     wp_1.close()
     wp_2.close()
@@ -242,7 +310,7 @@ if __name__ == "__main__":
     plt.xlabel("Iteration")
     plt.ylabel("QBER")
     plt.tight_layout(pad=0.1)
-    plt.savefig("./PolarizationStabilizationTest.jpg", dpi=600)
+    plt.savefig("./PolarizationStabilizationTest.jpg", dpi=150)
     plt.show()
 
     # Plot and save positions:
@@ -256,5 +324,5 @@ if __name__ == "__main__":
     plt.xlabel("Iteration")
     plt.ylabel("Pos. (deg.)")
     plt.tight_layout(pad=0.1)
-    plt.savefig("./PosWaveplatesTest.jpg", dpi=600)
+    plt.savefig("./PosWaveplatesTest.jpg", dpi=150)
     plt.show()
@@ -1,6 +1,9 @@
 import serial
+import struct
 import time
 
+_pack_u32 = struct.Struct('>I').pack  # 32-bit unsigned, big endian
+
 class ElliptecController:
     """Class to connect to and control Thorlabs Elliptec ELL14 rotation stages"""
     # Class variables for serial communication
@@ -9,10 +12,14 @@ class ElliptecController:
     pulses_per_turn = 143360 # We tested that this is the correct number of steps for a single
     # turn, but we have have NO IDEA why this is. The ELL manual specifies 262144 (2^18) pulses per turn,
     # but this is wrong and we don't know why.
+    _PULSES_PER_DEG = pulses_per_turn / 360.0  # precomputed conversion factors
+    _DEG_PER_PULSE = 360.0 / pulses_per_turn
+    _RESPONSE_TAIL_TIMEOUT = 0.1  # s, rest of a response once its first byte arrived (~15 ms at 9600 baud)
 
     def __init__(self, port='COM5', baudrate=9600, address='0', verbose=False):
         # Connection details to establish serial connection
         self.address = address  # hex address (0‑F)
+        self._addr_bytes = address.encode('ascii')
         self.verbose = verbose
 
         if not hasattr(self, "ser"):  # only initialize connection if it doesn't already exist 
@@ -37,25 +44,74 @@ class ElliptecController:
 
     def _send_cmd(self, cmd: str):
         """Send command (without CRLF), add CR (0x0D) and LF (0x0A) terminator according to manual"""
-        full = f"{self.address}{cmd}"
-        # send as ASCII bytes
-        self.ser.write(full.encode('ascii'))
-        self.ser.write(b'\r\n')
+        self._send_cmd_async(cmd)
         # wait for response
-        resp = self.ser.readline().decode('ascii', errors='ignore').strip()
-        return resp
-    
+        return self._read_response()
+
+    def _send_cmd_async(self, cmd: str):
+        """Send command without waiting for the response. Devices with different addresses on the
+        same bus can then move simultaneously; collect the responses with await_moves()."""
+        # send as ASCII bytes, address, command and terminator in a single write
+        self.ser.write(self._addr_bytes + cmd.encode('ascii') + b'\r\n')
+
+    @staticmethod
+    def await_moves(*controllers):
+        """Wait for the responses of moves started with start_move_absolute_*() on several devices
+        and update their positions. Each device answers when its own move is finished, so the
+        responses can arrive in any order and are routed by their leading address character.
+        Returns the responses in the order of the given controllers ('' if none was received)."""
+        pending = {c.address: c for c in controllers}
+        resps = {}
+        while pending:
+            resp = controllers[0]._read_response()
+            if not resp:
+                break  # timeout, no more responses
+            wp = pending.pop(resp[0], None)
+            if wp is None:
+                print(f"⚠ Respuesta inesperada del actuador: '{resp}'")
+                continue
+            wp._update_position(resp)
+            resps[wp.address] = resp
+        for address in pending:
+            print(f"⚠ Sin respuesta del actuador {address}")
+        return tuple(resps.get(c.address, '') for c in controllers)
+
+    def _read_response(self):
+        """Read a single CRLF terminated response. The first byte may take up to the full timeout
+        (moves are answered when finished), the rest of the line only gets a short deadline so that
+        a truncated response does not block for another 2 s. Reading stops after 64 bytes.
+        The port timeout itself is never changed, as that reconfigures the port on every call."""
+        ser = self.ser
+        buf = bytearray(ser.read(1))
+        if not buf:
+            return ''
+        deadline = time.monotonic() + ElliptecController._RESPONSE_TAIL_TIMEOUT
+        while not buf.endswith(b'\r\n') and len(buf) < 64:
+            if ser.in_waiting:
+                # One byte at a time, so a following response (of another device) stays in the buffer
+                buf += ser.read(1)
+            elif time.monotonic() < deadline:
+                time.sleep(0.001)
+            else:
+                break
+        return buf.decode('ascii', errors='ignore').strip()
+
     def _deg_to_pulses(self, degrees: float):
         """Convert degrees to pulses (integer)."""
-        return int(degrees * self.pulses_per_turn / 360)
+        return int(degrees * ElliptecController._PULSES_PER_DEG)
 
     def _pulses_to_deg(self, pulses: int):
         """Convert pulses to degrees (float)."""
         # Handle signed 32-bit values
         if pulses >= 0x80000000:
             pulses -= 0x100000000
-        return pulses * 360.0 / self.pulses_per_turn
+        return pulses * ElliptecController._DEG_PER_PULSE
     
+    @staticmethod
+    def _pulses_to_hex(pulses: int):
+        """Encode pulses as 32-bit (4 bytes) big endian hexadecimal, as expected by the device."""
+        return _pack_u32(pulses & 0xFFFFFFFF).hex().upper()
+
     def _update_position(self, resp: str):
         """Update position whenever response is received from device. The class automatically calls
         this function after every move, so there is usually no need to update the position manually."""
@@ -93,7 +149,7 @@ class ElliptecController:
     def move_absolute(self, pulses: int):
         """Command MA: move to absolute position in pulse counts"""
         # pulses must be encoded as 32-bit (4 bytes) big endian hexadecimal
-        hexval = format(pulses & 0xFFFFFFFF, '08X')
+        hexval = self._pulses_to_hex(pulses)
         cmd = f"ma{hexval}"
         resp = self._send_cmd(cmd)
         self._update_position(resp)
@@ -101,9 +157,20 @@ class ElliptecController:
             # print(f"Moved device {self.address} to position {self.position:.2f}°")
         return resp
 
+    def start_move_absolute_hex(self, hexval: str):
+        """Command MA with a position already encoded as 8-digit hexadecimal pulses, without
+        waiting for the response. Scans precompute all positions so no conversion is done per move.
+        Collect the response with await_moves()."""
+        self._send_cmd_async(f"ma{hexval}")
+
+    def start_move_absolute_deg(self, degrees: float):
+        """Command MA: start moving to absolute position in degrees without waiting for the
+        response. Collect the response with await_moves()."""
+        self.start_move_absolute_hex(self._pulses_to_hex(self._deg_to_pulses(degrees)))
+
     def move_relative(self, pulses: int):
         """Command MR: move relative by pulse counts"""
-        hexval = format(pulses & 0xFFFFFFFF, '08X')
+        hexval = self._pulses_to_hex(pulses)
         cmd = f"mr{hexval}"
         resp = self._send_cmd(cmd)
         self._update_position(resp)
@@ -115,7 +182,7 @@ class ElliptecController:
         """Command MA: move to absolute position in pulse counts"""
         # pulses must be encoded as 32-bit (4 bytes) big endian hexadecimal
         pulses = self._deg_to_pulses(degrees)
-        hexval = format(pulses & 0xFFFFFFFF, '08X')
+        hexval = self._pulses_to_hex(pulses)
         cmd = f"ma{hexval}"
         resp = self._send_cmd(cmd)
         self._update_position(resp)
@@ -126,7 +193,7 @@ class ElliptecController:
     def move_relative_deg(self, degrees: float):
         """Command MR: move relative by pulse counts"""
         pulses = self._deg_to_pulses(degrees)
-        hexval = format(pulses & 0xFFFFFFFF, '08X')
+        hexval = self._pulses_to_hex(pulses)
         cmd = f"mr{hexval}"
         resp = self._send_cmd(cmd)
         self._update_position(resp)
@@ -36,18 +36,35 @@ class QBERWaveplateMapper:
         self.angles_wp1 = np.arange(-180, 180 + step_wp1, step_wp1)
         self.angles_wp2 = np.arange(-180, 180 + step_wp2, step_wp2)
 
-        # Storage matrix
-        self.qber_map = np.zeros((len(self.angles_wp2), len(self.angles_wp1)))
+        # Storage matrices: count rates per point, QBER computed after the scan
+        shape = (len(self.angles_wp2), len(self.angles_wp1))
+        self.cts_h = np.zeros(shape, dtype=np.float32)
+        self.cts_v = np.zeros(shape, dtype=np.float32)
+        self.qber_map = np.zeros(shape, dtype=np.float32)
+
+    def compute_qber_map(self):
+        """Compute the QBER of all points at once from the stored counts."""
+        tot = self.cts_h + self.cts_v
+        self.qber_map[:] = 0
+        np.divide(self.cts_h, tot, out=self.qber_map, where=tot > 0)
+        return self.qber_map
+
+    def save_npz(self):
+        """Save counts, QBER map and angle ranges to a compressed .npz next to filename."""
+        np.savez_compressed(self.filename.replace('.txt', '.npz'),
+                            h=self.cts_h, v=self.cts_v, q=self.qber_map,
+                            angles_wp1=self.angles_wp1, angles_wp2=self.angles_wp2)
 
     def plot_heatmap(self):
         plt.figure(figsize=(8, 6))
-        plt.imshow(
+        qm = plt.pcolormesh(
+            self.angles_wp1,
+            self.angles_wp2,
             self.qber_map,
-            extent=[-180, 180, -180, 180],
-            origin='lower',
-            aspect='auto',
+            shading='nearest',
             cmap='viridis'
         )
+        qm.set_rasterized(True)
         plt.colorbar(label="QBER")
         plt.xlabel("QWP angle (°)")
         plt.ylabel("HWP angle (°)")
@@ -63,13 +80,6 @@ if __name__ == "__main__":
     step_wp1 = 1
     step_wp2 = 1
 
-    # Angles from -180° to +180°
-    angles_wp1 = np.arange(-180, 180 + step_wp1, step_wp1)
-    angles_wp2 = np.arange(-180, 180 + step_wp2, step_wp2)
-
-    # QBER storage matrix
-    qber_map = np.zeros((len(angles_wp2), len(angles_wp1)))
-
     # Initialize waveplates
     wp_1 = ElliptecController(address="0", verbose=True)
     wp_2 = ElliptecController(address="2", verbose=True)
@@ -83,55 +93,79 @@ if __name__ == "__main__":
     ctr = TimeTagger.Countrate(tagger, tt_channels)
     time.sleep(1)
 
+    # Angles from -180° to +180° and count storage matrices
+    mapper = QBERWaveplateMapper((wp_1, wp_2), ctr, step_wp1=step_wp1, step_wp2=step_wp2,
+                                 indiv_meas_duration=indiv_meas_duration)
+    angles_wp1 = mapper.angles_wp1
+    angles_wp2 = mapper.angles_wp2
+    cts_h_map = mapper.cts_h
+    cts_v_map = mapper.cts_v
+
+    # Precompute pulse counts and hex commands for all angles of the scan
+    pulses1 = (angles_wp1 * ElliptecController._PULSES_PER_DEG).astype(np.int32)
+    pulses2 = (angles_wp2 * ElliptecController._PULSES_PER_DEG).astype(np.int32)
+    hex1 = [ElliptecController._pulses_to_hex(p) for p in pulses1.tolist()]
+    hex2 = [ElliptecController._pulses_to_hex(p) for p in pulses2.tolist()]
+
     # -----------------------------------------------------------
     #                    CORE DOUBLE LOOP
     # -----------------------------------------------------------
-    with open("map_qber.txt", "w") as f:
-        f.write("angle_wp1\tangle_wp2\tcts_h\tcts_v\tqber\n")
-
+    # All points are collected in memory and written to file once at the end
+    n_wp2 = len(angles_wp2)
+    log = np.empty((len(angles_wp1) * n_wp2, 5), dtype=float)
+    k = 0
+    # Local names for the methods called at every point
+    move1, move2 = wp_1.start_move_absolute_hex, wp_2.start_move_absolute_hex
+    await_moves = ElliptecController.await_moves
+    ctr_clear, ctr_start, ctr_wait, ctr_data = ctr.clear, ctr.startFor, ctr.waitUntilFinished, ctr.getData
+    meas_duration_ps = int(indiv_meas_duration * 1e12)
+    try:
         for i, angle_wp1 in enumerate(angles_wp1):
-            for j, angle_wp2 in enumerate(angles_wp2):
-
-                wp_1.move_absolute_deg(angle_wp1) # Move waveplate 1
-                if j==0:
-                    wp_2.move_absolute_deg(angle_wp2) # Move waveplate 2 
-                    time.sleep(1) # Wait for completion (waveplate 2 goes from 180 to -180)
-                else:
-                    wp_2.move_absolute_deg(angle_wp2) # Move waveplate 2
-
-                # Wait for measurement
-                ctr = TimeTagger.Countrate(tagger, tt_channels) # CRITICAL
-                time.sleep(indiv_meas_duration)
+            # Snake scan: reverse waveplate 2 on odd columns so it never rewinds 360°
+            inner = angles_wp2 if i % 2 == 0 else angles_wp2[::-1]
+            for j_rel, angle_wp2 in enumerate(inner):
+                j = j_rel if i % 2 == 0 else n_wp2 - 1 - j_rel
+
+                # Move both waveplates simultaneously, then collect both responses
+                move1(hex1[i])
+                move2(hex2[j])
+                await_moves(wp_1, wp_2)
+                if i==0 and j_rel==0:
+                    time.sleep(1) # Wait for completion (waveplate 2 goes from home to -180)
+
+                # Measure for a clean window with the counter created above
+                ctr_clear()
+                ctr_start(meas_duration_ps, clear=True)
+                ctr_wait()
                 # Read counts
-                cts_h = ctr.getData()[0] # Channel 3 (H)
-                cts_v = ctr.getData()[1] # Channel 4 (V)
+                data = ctr_data()
+                cts_h = data[0] # Channel 3 (H)
+                cts_v = data[1] # Channel 4 (V)
                 # Compute QBER safely
                 qber = cts_h / (cts_h + cts_v) if (cts_h + cts_v) > 0 else 0
 
-                # Store QBER in matrix
-                qber_map[j, i] = qber
-
-                # Save to file
-                f.write(f"{angle_wp1}\t{angle_wp2}\t{cts_h}\t{cts_v}\t{qber}\n")
-                print(f"QBER={qber:.4f} at (QWP={angle_wp1}°, HWP={angle_wp2}°)")
-
+                # Store counts in matrices
+                cts_h_map[j, i] = cts_h
+                cts_v_map[j, i] = cts_v
+
+                # Store row for the output file
+                log[k] = (angle_wp1, angle_wp2, cts_h, cts_v, qber)
+                k += 1
+
+            # One summary line per waveplate 1 position
+            row_qbers = log[k - n_wp2:k, 4]
+            j_min = int(row_qbers.argmin())
+            print(f"QWP={angle_wp1}°: min QBER={row_qbers[j_min]:.4f} at HWP={log[k - n_wp2 + j_min, 1]:g}°")
+    finally:
+        # Save whatever was measured, also if the scan was interrupted
+        np.savetxt(mapper.filename, log[:k], fmt="%.12g", delimiter="\t",
+                   header="angle_wp1\tangle_wp2\tcts_h\tcts_v\tqber", comments="")
+        # Compute QBER of all points at once and save all matrices in
+        # compressed binary form for further analysis
+        mapper.compute_qber_map()
+        mapper.save_npz()
 
     # -----------------------------------------------------------
     #                    HEATMAP
     # -----------------------------------------------------------
-    plt.figure(figsize=(8, 6))
-    plt.imshow(
-        qber_map,
-        extent=[-180, 180, -180, 180],
-        origin='lower',
-        aspect='auto',
-        cmap='viridis'
-    )
-    plt.colorbar(label="QBER")
-    plt.xlabel("QWP angle (°)")
-    plt.ylabel("HWP angle (°)")
-    plt.title("QBER Map: QWP vs HWP")
-    plt.tight_layout()
-    plt.show()
-
-
+    mapper.plot_heatmap()